@@ -2,36 +2,278 @@
 
 Select a single imap folder
 Download entire contents into a mbox folder
-Zip the folder
-Create a new email with the zip file as an enclosure
+Zip the folder, or compress it to a multistream .mbox.bz2 file
+Create a new email with the archive as an enclosure
 Replace it as a new email message in the user INBOX folder
 
 Optionally delete the original folder.
 """
 
 
+import base64
+import bz2
+import collections
+import contextlib
 import logging
+import mmap
+import os
+import queue
+import threading
 import tempfile
 import pathlib
+import time
 import imaplib
-import email
-import mailbox
+import io
+import re
+import uuid
+import zlib
+import email.message
+import email.policy
+import email.utils
 import zipfile
+from concurrent.futures import ThreadPoolExecutor
 
 
 logger = logging.getLogger(__name__)
-DEBUG = True
-if DEBUG:
-    logger.setLevel(logging.DEBUG)
-    logger.debug("Logging started")
+# checked once, so the per-message debug calls cost nothing when off
+_DBG = logger.isEnabledFor(logging.DEBUG)
+
+
+# literals larger than this are read from the socket into a spool file
+LITERAL_THRESHOLD = 1 << 16
+LITERAL_CHUNK_SIZE = 1 << 16
+SPOOL_MAX_SIZE = 1 << 20
+
+# size of each write into the zip archive
+ZIP_WRITE_SIZE = 1 << 16
+
+# zip bytes base64 encoded at a time; a multiple of 57 keeps whole lines
+BASE64_CHUNK_SIZE = 57 * 1024
+
+# compresslevel used when collect_emails isn't given one
+DEFAULT_COMPRESSLEVELS = {zipfile.ZIP_DEFLATED: 6, zipfile.ZIP_BZIP2: 9}
+
+# chunks of mbox text waiting to be compressed
+PIPELINE_QUEUE_SIZE = 8
+
+# uncompressed size of each independently compressed bzip2 stream
+BZ2_BLOCK_SIZE = 900 * 1024
+
+# number of messages requested by each UID FETCH command; every literal
+# in a batch is held, in memory or a temp file, until it is written
+FETCH_BATCH_SIZE = 100
+
+# total RFC822.SIZE of the messages in one batch, unless a single message
+# is bigger; with FETCH_AHEAD this bounds the memory and temp files used
+FETCH_BATCH_BYTES = 8 << 20
+
+# header-only and size fetches return small responses, so ask for more
+HEADER_BATCH_SIZE = 500
+
+# default number of connections fetching a folder at once; the login
+# dict may set "connections" to override it
+DEFAULT_CONNECTIONS = 3
+
+# batches fetched or being fetched ahead of the one being written, per
+# connection
+FETCH_AHEAD = 2
+
+_DONE = object()
+_UID_RE = re.compile(rb"\bUID (\d+)")
+_SIZE_RE = re.compile(rb"\bRFC822\.SIZE (\d+)")
+_FROM_RE = re.compile(rb">*From ")
+
+# replace "/*. " with "_" in file names
+_FNAME_TRANS = str.maketrans("/*. ", "____")
+
+
+# imaplib refuses commands it doesn't know; RFC 4978 COMPRESS
+imaplib.Commands.setdefault("COMPRESS", ("AUTH", "SELECTED"))
 
 
 class ImapRuntimeError(RuntimeError):
     """Report IMAP protocol error."""
 
 
+def _preallocate(fileobj, size):
+    """Reserve disk space for a file of known size, where supported."""
+
+    if not hasattr(os, "posix_fallocate"):
+        return
+
+    try:
+        os.posix_fallocate(fileobj.fileno(), 0, size)
+    except OSError:
+        # not all filesystems support it; the writes will still succeed
+        pass
+
+
+class _FileLiteral:
+    """A binary file to be sent as an IMAP literal of known size."""
+
+    def __init__(self, fileobj, size):
+        self.fileobj = fileobj
+        self.size = size
+
+    def __len__(self):
+        return self.size
+
+
+class SpoolingIMAP4_SSL(imaplib.IMAP4_SSL):  # pylint: disable=invalid-name
+    """IMAP4_SSL connection which spools large literals to a file.
+
+    Literals over LITERAL_THRESHOLD bytes are returned as a binary temp
+    file, positioned at the start, instead of bytes. Literals too big to
+    keep in memory go to a preallocated file on disk.
+    append_file() sends a message from a file in the same way.
+
+    compress() turns on COMPRESS=DEFLATE, after which all traffic passes
+    through a raw deflate stream in each direction.
+    """
+
+    _compressor = None
+    _decompressor = None
+    _inbuf = None
+    _inpos = 0
+
+    def compress(self):
+        """Turn on RFC 4978 compression if the server supports it.
+
+        Returns True if the connection is now compressed.
+        """
+
+        try:
+            # servers may only advertise COMPRESS once logged in
+            self._get_capabilities()
+            if "COMPRESS=DEFLATE" not in self.capabilities:
+                return False
+
+            typ, _ = self._simple_command("COMPRESS", "DEFLATE")
+
+        except self.abort:
+            raise
+
+        except self.error as err:
+            # a BAD reply; carry on uncompressed
+            logger.info("COMPRESS refused: %s", err)
+            return False
+
+        if typ != "OK":
+            return False
+
+        self._start_compression()
+        return True
+
+    def _start_compression(self):
+        self._compressor = zlib.compressobj(wbits=-15)
+        self._decompressor = zlib.decompressobj(wbits=-15)
+        self._inbuf = bytearray()
+        self._inpos = 0
+
+    def _send_bytes(self, data):
+        if self._compressor is not None:
+            data = self._compressor.compress(data) + self._compressor.flush(
+                zlib.Z_SYNC_FLUSH)
+        super().send(data)
+
+    def _fill(self):
+        """Decompress up to LITERAL_CHUNK_SIZE more bytes into _inbuf.
+
+        Data before _inpos has been consumed and is dropped first.
+        """
+
+        del self._inbuf[:self._inpos]
+        self._inpos = 0
+
+        data = self._decompressor.unconsumed_tail
+        if not data:
+            data = self.file.read1(LITERAL_CHUNK_SIZE)
+            if not data:
+                raise imaplib.IMAP4.abort("socket error: EOF")
+        self._inbuf += self._decompressor.decompress(
+            data, LITERAL_CHUNK_SIZE)
+
+    def _read_bytes(self, size):
+        if self._decompressor is None:
+            return super().read(size)
+
+        while len(self._inbuf) - self._inpos < size:
+            self._fill()
+        end = self._inpos + size
+        data = bytes(self._inbuf[self._inpos:end])
+        self._inpos = end
+        return data
+
+    def readline(self):
+        if self._decompressor is None:
+            return super().readline()
+
+        scanned = self._inpos
+        end = self._inbuf.find(b"\n", scanned) + 1
+        while not end:
+            # pylint: disable=protected-access
+            if len(self._inbuf) - self._inpos > imaplib._MAXLINE:
+                raise self.error(
+                    "got more than %d bytes" % imaplib._MAXLINE)
+            scanned = len(self._inbuf) - self._inpos
+            self._fill()
+            end = self._inbuf.find(b"\n", scanned) + 1
+
+        line = bytes(self._inbuf[self._inpos:end])
+        self._inpos = end
+        return line
+
+    def append_file(self, mailbox, message, size):
+        """Append size bytes read from binary file message to mailbox.
+
+        The message must already have CRLF line endings.
+        """
+
+        self.literal = _FileLiteral(message, size)
+        return self._simple_command("APPEND", mailbox or "INBOX")
+
+    def send(self, data):
+        if not isinstance(data, _FileLiteral):
+            self._send_bytes(data)
+            return
+
+        remaining = data.size
+        while remaining:
+            chunk = data.fileobj.read(min(remaining, LITERAL_CHUNK_SIZE))
+            if not chunk:
+                raise ImapRuntimeError("Message file is shorter than its size")
+            self._send_bytes(chunk)
+            remaining -= len(chunk)
+
+    def read(self, size):
+        if size <= LITERAL_THRESHOLD:
+            return self._read_bytes(size)
+
+        if size > SPOOL_MAX_SIZE:
+            spool = tempfile.TemporaryFile()
+            _preallocate(spool, size)
+        else:
+            spool = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE)
+
+        remaining = size
+        while remaining:
+            chunk = self._read_bytes(min(remaining, LITERAL_CHUNK_SIZE))
+            if not chunk:
+                raise imaplib.IMAP4.abort("socket closed reading literal")
+            spool.write(chunk)
+            remaining -= len(chunk)
+
+        spool.seek(0)
+        return spool
+
+
 def open_connection(login, verbose=False):
-    """Connect to the server."""
+    """Connect to the server.
+
+    The connection is compressed if the server supports it, unless
+    login["compress"] is false, as is worth doing for folders mostly of
+    already compressed attachments.
+    """
 
     logger.info("Logging into %s: %s", login["hostname"], login["username"])
 
@@ -39,15 +281,41 @@ def open_connection(login, verbose=False):
         imaplib.Debug = 4
 
     try:
-        conn = imaplib.IMAP4_SSL(login["hostname"], login["port"])
+        conn = SpoolingIMAP4_SSL(login["hostname"], login["port"])
         conn.login(login["username"], login["password"])
 
+        if login.get("compress", True) and conn.compress():
+            logger.info("Using COMPRESS=DEFLATE.")
+
     except (OSError, imaplib.IMAP4.error) as err:
         raise ImapRuntimeError(str(err)) from None
 
     return conn
 
 
+def close_connection(connection):
+    """Log out, ignoring a connection which has already failed."""
+
+    try:
+        connection.logout()
+    except (OSError, imaplib.IMAP4.error):
+        pass
+
+
+def refresh_connection(connection, login):
+    """Return the connection if it is still alive, else a new one."""
+
+    try:
+        connection.noop()
+
+    except (OSError, imaplib.IMAP4.abort) as err:
+        logger.info("Connection lost (%s), logging in again.", err)
+        close_connection(connection)
+        return open_connection(login)
+
+    return connection
+
+
 class GetTempdir:
     """Get the name of a temporary directory."""
 
@@ -87,16 +355,45 @@ class GetTempdir:
 def make_file_name(directory, folder, extension):
     """Get a legal file name and return a Path object."""
 
-    # replace "/*. " with "_"
-    folder_mod = folder.translate({47: 95, 42: 95, 46: 95, 32: 95})
+    folder_mod = folder.translate(_FNAME_TRANS)
 
     return pathlib.Path(directory).joinpath(
         folder_mod + (("." + extension) if extension else "")
     )
 
 
-def get_folder_emails(connection, folder):
-    """Generator function: open a connection and yield the folder contents."""
+def _uid_slices(uid_list, size):
+    """Yield (index, uids) for successive slices of up to size UIDs."""
+
+    for index, start in enumerate(range(0, len(uid_list), size)):
+        yield index, uid_list[start:start + size]
+
+
+def _fetch_responses(data):
+    """Yield (uid, items, literal) for each message in a FETCH response.
+
+    items is the response text around the literal, holding any other
+    data items that were asked for.
+    """
+
+    for index, item in enumerate(data):
+        if not isinstance(item, tuple):
+            continue
+
+        # data items may be sent before or after the literal
+        items = item[0]
+        if index + 1 < len(data) and isinstance(data[index + 1], bytes):
+            items += data[index + 1]
+
+        match = _UID_RE.search(items)
+        if not match:
+            raise ImapRuntimeError("No UID in fetch response")
+
+        yield int(match.group(1)), items, item[1]
+
+
+def select_folder(connection, folder):
+    """Select the folder and return a list of its message UIDs."""
 
     typ, data = connection.select(folder)
     if typ != "OK":
@@ -107,95 +404,615 @@ def get_folder_emails(connection, folder):
     if typ != "OK":
         raise ImapRuntimeError("Search failed")
 
-    uid_list = data[0].decode("us-ascii").split()
-    logger.debug("Found %d messages to retrieve", len(uid_list))
+    return data[0].decode("us-ascii").split()
+
+
+def fetch_sizes(connection, uid_list):
+    """Return a dict mapping each UID in uid_list to its RFC822.SIZE."""
 
+    sizes = {}
+    for _, uids in _uid_slices(uid_list, HEADER_BATCH_SIZE):
+        typ, data = connection.uid(
+            "fetch", ",".join(uids), "(UID RFC822.SIZE)")
+        if typ != "OK":
+            raise ImapRuntimeError("Fetch failed")
+
+        for item in data:
+            if not isinstance(item, bytes):
+                continue
+            uid, size = _UID_RE.search(item), _SIZE_RE.search(item)
+            if uid and size:
+                sizes[uid.group(1).decode("us-ascii")] = int(size.group(1))
+
+    return sizes
+
+
+def plan_batches(connection, uid_list):
+    """Split uid_list into batches for fetch_batch.
+
+    A batch holds up to FETCH_BATCH_SIZE messages, and up to
+    FETCH_BATCH_BYTES of them unless a single message is bigger.
+    """
+
+    sizes = fetch_sizes(connection, uid_list)
+
+    batches, batch, batch_bytes = [], [], 0
     for uid in uid_list:
+        size = sizes.get(uid, 0)
+        if batch and (len(batch) == FETCH_BATCH_SIZE
+                      or batch_bytes + size > FETCH_BATCH_BYTES):
+            batches.append(batch)
+            batch, batch_bytes = [], 0
+        batch.append(uid)
+        batch_bytes += size
+
+    if batch:
+        batches.append(batch)
+
+    return batches
+
+
+def fetch_batch(connection, uid_list):
+    """Fetch the messages in uid_list, returning a list of binary files.
+
+    uid_list is one of the batches from plan_batches. The caller is
+    responsible for closing the files.
+    """
+
+    typ, data = connection.uid(
+        "fetch", ",".join(uid_list), "(UID BODY.PEEK[])")
+    if typ != "OK":
+        raise ImapRuntimeError("Fetch failed")
+
+    batch = []
+    for uid, _, eml in _fetch_responses(data):
+        if _DBG:
+            logger.debug("Retrieved message %d.", uid)
+        if isinstance(eml, bytes):
+            eml = io.BytesIO(eml)
+        batch.append(eml)
+
+    return batch
+
+
+def fetch_headers(connection, uid_list):
+    """Generator function: yield (uid, headers, size, date) per message.
+
+    Only the header is fetched. size is the RFC822.SIZE of the whole
+    message and date its INTERNALDATE as a time.struct_time.
+    """
 
-        typ, data = connection.uid("fetch", uid, "(RFC822)")
+    for _, uids in _uid_slices(uid_list, HEADER_BATCH_SIZE):
+        typ, data = connection.uid(
+            "fetch",
+            ",".join(uids),
+            "(UID BODY.PEEK[HEADER] RFC822.SIZE INTERNALDATE)",
+        )
         if typ != "OK":
             raise ImapRuntimeError("Fetch failed")
-        logger.debug("Retrieved message %d.", int(uid))
 
-        yield data[0][1]
+        for uid, items, headers in _fetch_responses(data):
+            if not isinstance(headers, bytes):
+                with headers:
+                    headers = headers.read()
+
+            size = _SIZE_RE.search(items)
+            yield (
+                uid,
+                headers,
+                int(size.group(1)) if size else None,
+                imaplib.Internaldate2tuple(items),
+            )
+
+
+def _close_batch(batch):
+    """Close the files of a fetched batch."""
+    for eml in batch:
+        eml.close()
+
+
+def get_folder_emails(connection, folder, body=True):
+    """Generator function: yield the folder contents as binary files.
+
+    This fetches over the one connection; collect_emails uses
+    get_folder_emails_parallel. If body is False, only the headers are
+    fetched and the tuples from fetch_headers are yielded instead.
+    """
+
+    uid_list = select_folder(connection, folder)
+    logger.debug("Found %d messages to retrieve", len(uid_list))
+
+    if not body:
+        yield from fetch_headers(connection, uid_list)
+        return
+
+    for uids in plan_batches(connection, uid_list):
+        batch = fetch_batch(connection, uids)
+        try:
+            yield from batch
+
+        finally:
+            _close_batch(batch)
+
+
+def _put(messages, item, stop):
+    """Put item on the queue unless the consumer has stopped."""
+
+    while not stop.is_set():
+        try:
+            messages.put(item, timeout=0.5)
+            return True
+        except queue.Full:
+            pass
+
+    return False
+
+
+def _fetch_worker(connection, batches, results, slots, stop):
+    """Fetch (index, uid_list) batches from the batches queue.
+
+    Each fetched batch is put on results as (index, files), once a slot
+    is free. Ends by putting _DONE, or the exception which stopped it.
+    """
+
+    result = _DONE
+    try:
+        while not stop.is_set():
+            if not slots.acquire(timeout=0.5):
+                continue
+
+            try:
+                index, uid_list = batches.get_nowait()
+            except queue.Empty:
+                slots.release()
+                break
+
+            results.put((index, fetch_batch(connection, uid_list)))
+
+    except Exception as err:  # pylint: disable=broad-except
+        result = err
+
+    finally:
+        results.put(result)
+
+
+def get_folder_emails_parallel(login, folder, connection, pool=None):
+    """Generator function: yield the folder contents as binary files.
+
+    The folder's batches are shared between up to login["connections"]
+    connections, including the one passed in, which fetch in parallel.
+    Fewer are used if the server refuses further logins. Messages are
+    yielded in UID order. Each connection runs at most FETCH_AHEAD
+    batches from plan_batches ahead of the one being written.
+
+    pool is an optional list of further open connections, used before
+    logging in again. Connections opened here are added to it and left
+    open; without a pool they are logged out at the end.
+    """
+
+    uid_list = select_folder(connection, folder)
+    logger.debug("Found %d messages to retrieve", len(uid_list))
+
+    batches = queue.Queue()
+    for index, uids in enumerate(plan_batches(connection, uid_list)):
+        batches.put((index, uids))
 
+    max_connections = min(
+        int(login.get("connections", DEFAULT_CONNECTIONS)),
+        batches.qsize(),
+    )
+
+    connections = [connection]
+    results = queue.Queue()
+    stop = threading.Event()
+    pending = {}
+
+    spare = list(pool or ())
 
-def place_message(connection, tempdir, folder_name):
-    """Create a new message with zip file, place it in INBOX."""
+    try:
+        while len(connections) < max_connections:
+            try:
+                if spare:
+                    extra = refresh_connection(spare.pop(0), login)
+                else:
+                    extra = open_connection(login)
+            except ImapRuntimeError as err:
+                logger.warning("Fetching with %d connections: %s",
+                               len(connections), err)
+                break
 
-    zip_path = make_file_name(tempdir, folder_name, "zip")
+            try:
+                select_folder(extra, folder)
+            except (OSError, imaplib.IMAP4.error, ImapRuntimeError) as err:
+                close_connection(extra)
+                logger.warning("Fetching with %d connections: %s",
+                               len(connections), err)
+                break
+            connections.append(extra)
+
+        slots = threading.Semaphore(FETCH_AHEAD * len(connections))
+
+        with ThreadPoolExecutor(max_workers=len(connections)) as executor:
+            for conn in connections:
+                executor.submit(
+                    _fetch_worker, conn, batches, results, slots, stop)
+
+            try:
+                next_index = 0
+                running = len(connections)
+                while running:
+                    item = results.get()
+                    if item is _DONE:
+                        running -= 1
+                        continue
+                    if isinstance(item, (OSError, imaplib.IMAP4.error)):
+                        raise ImapRuntimeError(str(item)) from item
+                    if isinstance(item, Exception):
+                        raise item
+
+                    # batches may arrive out of order; write them in order
+                    index, batch = item
+                    pending[index] = batch
+                    while next_index in pending:
+                        batch = pending.pop(next_index)
+                        try:
+                            yield from batch
+                        finally:
+                            _close_batch(batch)
+                        next_index += 1
+                        slots.release()
+
+            finally:
+                stop.set()
+
+    finally:
+        while not results.empty():
+            item = results.get()
+            if isinstance(item, tuple):
+                _close_batch(item[1])
+        for batch in pending.values():
+            _close_batch(batch)
+
+        if pool is None:
+            for extra in connections[1:]:
+                close_connection(extra)
+        else:
+            pool[:] = connections[1:] + spare
+
+
+def frame_messages(messages, from_line):
+    """Generator function: yield the mbox text of the message files.
+
+    Each message starts with the from_line bytes, and the text is
+    yielded in chunks of about ZIP_WRITE_SIZE bytes. Messages are read
+    LITERAL_CHUNK_SIZE bytes at most at a time, so a long line is never
+    held in memory whole.
+    """
+
+    chunk = bytearray()
+    for eml in messages:
+        chunk += from_line
+
+        line_start = True
+        held_cr = False
+        while True:
+            piece = eml.readline(LITERAL_CHUNK_SIZE)
+            if not piece:
+                break
+
+            # a CR at the end of the last piece may begin a CRLF
+            if held_cr and not piece.startswith(b"\n"):
+                chunk += b"\r"
+            held_cr = False
+
+            # escape lines which would be read as a new message (mboxrd)
+            if line_start and _FROM_RE.match(piece):
+                chunk += b">"
+
+            if piece.endswith(b"\r\n"):
+                chunk += piece[:-2]
+                chunk += b"\n"
+            elif piece.endswith(b"\r"):
+                chunk += piece[:-1]
+                held_cr = True
+            else:
+                chunk += piece
+            line_start = piece.endswith(b"\n")
+
+            if len(chunk) >= ZIP_WRITE_SIZE:
+                yield bytes(chunk)
+                chunk.clear()
+
+        if held_cr:
+            chunk += b"\r"
+        if not line_start:
+            chunk += b"\n"
+        chunk += b"\n"
+        if _DBG:
+            logger.debug("Email saved.")
+
+    if chunk:
+        yield bytes(chunk)
+
+
+def _threaded(iterable, maxsize=PIPELINE_QUEUE_SIZE):
+    """Generator function: iterate over iterable in a background thread.
+
+    Items are handed over through a bounded queue, so the producer runs
+    up to maxsize items ahead of the consumer. An exception raised by
+    the producer is raised again in the consumer.
+    """
+
+    items = queue.Queue(maxsize=maxsize)
+    stop = threading.Event()
+
+    def produce():
+        result = _DONE
+        iterator = iter(iterable)
+        try:
+            for item in iterator:
+                if not _put(items, item, stop):
+                    break
+
+        except Exception as err:  # pylint: disable=broad-except
+            result = err
+
+        finally:
+            # a generator must be closed in the thread running it
+            if hasattr(iterator, "close"):
+                iterator.close()
+            _put(items, result, stop)
+
+    producer = threading.Thread(target=produce, daemon=True)
+    producer.start()
+
+    try:
+        while True:
+            item = items.get()
+            if item is _DONE:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+
+    finally:
+        stop.set()
+        producer.join()
+
+
+class ParallelBz2Writer(io.RawIOBase):
+    """Binary file which compresses to bzip2 on several threads.
+
+    Data is cut into BZ2_BLOCK_SIZE blocks, each compressed as a separate
+    bzip2 stream and written to fileobj in order. The result is a
+    multistream bzip2 file, which bzip2 readers decompress as one.
+    Closing the writer flushes it but does not close fileobj.
+    """
+
+    def __init__(self, fileobj, compresslevel=9, workers=None):
+        super().__init__()
+        self.fileobj = fileobj
+        self.compresslevel = compresslevel
+        self.workers = workers or os.cpu_count() or 1
+        self._executor = ThreadPoolExecutor(max_workers=self.workers)
+        self._pending = collections.deque()
+        self._block = bytearray()
+        self._streams = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._block += data
+        while len(self._block) >= BZ2_BLOCK_SIZE:
+            self._submit(bytes(self._block[:BZ2_BLOCK_SIZE]))
+            del self._block[:BZ2_BLOCK_SIZE]
+
+        return len(data)
+
+    def _submit(self, block):
+        # bz2 releases the GIL, so blocks are compressed concurrently
+        self._streams += 1
+        self._pending.append(
+            self._executor.submit(bz2.compress, block, self.compresslevel)
+        )
+        while len(self._pending) > 2 * self.workers:
+            self.fileobj.write(self._pending.popleft().result())
+
+    def close(self):
+        if self.closed:
+            return
+
+        try:
+            # empty input still needs one stream to be a valid bzip2 file
+            if self._block or not self._streams:
+                self._submit(bytes(self._block))
+                self._block.clear()
+            while self._pending:
+                self.fileobj.write(self._pending.popleft().result())
+
+        finally:
+            self._executor.shutdown()
+            super().close()
+
+
+@contextlib.contextmanager
+def open_archive(archive_path, mbox_name, compression, compresslevel):
+    """Open a binary file writing the mbox into a new archive.
+
+    For ZIP_BZIP2 the archive is a multistream .mbox.bz2 file written by
+    ParallelBz2Writer, rather than a zip, since zipfile would compress
+    it as a single stream on one core. Otherwise it is a zip file with
+    the mbox as its member mbox_name.
+    """
+
+    if compression == zipfile.ZIP_BZIP2:
+        with open(archive_path, "xb") as bz2_file, ParallelBz2Writer(
+            bz2_file, compresslevel
+        ) as mbox_file:
+            yield mbox_file
+
+    else:
+        with zipfile.ZipFile(
+            archive_path,
+            mode="x",
+            compression=compression,
+            compresslevel=compresslevel,
+        ) as mbox_zip, mbox_zip.open(
+            mbox_name, mode="w", force_zip64=True
+        ) as mbox_file:
+            yield mbox_file
+
+
+def _header_bytes(msg):
+    """Return the headers of an EmailMessage, ending with a blank line."""
+
+    return b"".join(
+        msg.policy.fold_binary(name, value) for name, value in msg.items()
+    ) + b"\r\n"
+
+
+def _archive_chunks(archive_file):
+    """Yield BASE64_CHUNK_SIZE slices of the file from a memory map."""
+
+    # an empty file cannot be mapped
+    if not os.fstat(archive_file.fileno()).st_size:
+        return
+
+    with mmap.mmap(
+        archive_file.fileno(), 0, access=mmap.ACCESS_READ
+    ) as archive_contents:
+        for start in range(0, len(archive_contents), BASE64_CHUNK_SIZE):
+            yield archive_contents[start:start + BASE64_CHUNK_SIZE]
+
+
+def place_message(connection, archive_path, content_type="application/zip"):
+    """Create a new message with the archive file, place it in INBOX.
+
+    The message is built in a spool file, base64 encoding the archive
+    from a memory map, so neither is held in memory.
+    """
+
+    boundary = uuid.uuid4().hex
 
     logger.debug("Creating EmailMessage.")
 
-    msg = email.message.EmailMessage()
+    msg = email.message.EmailMessage(policy=email.policy.SMTP)
     msg["Subject"] = "Back up email folder"
     msg["From"] = "Self"
     msg["To"] = "Self"
     msg["Date"] = email.utils.formatdate()
-    msg.preamble = "Email backup file enclosed: {}".format(zip_path.name)
+    msg["MIME-Version"] = "1.0"
+    msg.add_header("Content-Type", "multipart/mixed", boundary=boundary)
+    preamble = "Email backup file enclosed: {}\r\n".format(
+        archive_path.name)
+
+    attachment = email.message.EmailMessage(policy=email.policy.SMTP)
+    attachment.add_header("Content-Type", content_type)
+    attachment.add_header("Content-Transfer-Encoding", "base64")
+    attachment.add_header(
+        "Content-Disposition", "attachment", filename=archive_path.name
+    )
 
-    maintype, subtype = "application", "zip"
+    with open(archive_path, "rb") as archive_file, \
+            tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE) as spool:
 
-    with open(zip_path, "rb") as zip_contents:
+        spool.write(_header_bytes(msg))
+        spool.write(preamble.encode("utf-8"))
+        spool.write("--{}\r\n".format(boundary).encode("us-ascii"))
+        spool.write(_header_bytes(attachment))
 
         logger.debug("Creating attachment.")
 
-        msg.add_attachment(
-            zip_contents.read(),
-            maintype=maintype,
-            subtype=subtype,
-            filename=zip_path.name,
-        )
+        for chunk in _archive_chunks(archive_file):
+            encoded = base64.encodebytes(chunk)
+            spool.write(encoded.replace(b"\n", b"\r\n"))
 
-    logger.debug("Posting message.")
-
-    typ, data = connection.append(
-        mailbox="INBOX", flags=None, date_time=None, message=msg.as_bytes()
-    )
-    if typ != "OK":
-        raise RuntimeError("Cannot post message: {!r}".format(data[0]))
+        spool.write("--{}--\r\n".format(boundary).encode("us-ascii"))
 
+        logger.debug("Posting message.")
 
-def collect_emails(login, folder, use_directory=None):
-    """Create a mbox and collect emails into it."""
+        size = spool.tell()
+        spool.seek(0)
+        typ, data = connection.append_file("INBOX", spool, size)
 
-    with GetTempdir(use_directory) as tempdir:
-        logger.debug("Tempdir dir is %s", tempdir)
+    if typ != "OK":
+        raise RuntimeError("Cannot post message: {!r}".format(data[0]))
 
-        mbox_path = make_file_name(tempdir, folder, "mbox")
-        logger.debug("Mbox path is %s", mbox_path.as_posix())
 
-        if mbox_path.exists():
-            mbox_path.unlink()
-        mbox = mailbox.mbox(mbox_path)
+def collect_emails(login, folder, use_directory=None,
+                   compression=zipfile.ZIP_DEFLATED, compresslevel=None,
+                   connection=None, pool=None):
+    """Create a mbox and collect emails into it.
 
-        with open_connection(login, verbose=DEBUG) as connection:
+    compression and compresslevel are passed on to zipfile.ZipFile,
+    except that ZIP_BZIP2 produces a multistream .mbox.bz2 file instead
+    of a zip. If compresslevel is None, the level for the compression
+    method comes from DEFAULT_COMPRESSLEVELS.
 
-            try:
-                for eml in get_folder_emails(connection, folder):
-                    mess = email.message_from_bytes(eml)
-                    mbox.add(mess)
-                    logger.debug("Email saved.")
+    If an open connection is passed in it is used instead of logging in,
+    and left open. Returns that connection, or its replacement if the
+    server dropped it; a replacement is closed if the backup fails.
+    pool is passed on to get_folder_emails_parallel, to keep the extra
+    fetch connections open as well.
+    """
 
-            except ImapRuntimeError as err:
-                logger.critical("Saving email failed: %s", err)
-                raise
+    if compresslevel is None:
+        compresslevel = DEFAULT_COMPRESSLEVELS.get(compression)
 
-            finally:
-                mbox.close()
+    with GetTempdir(use_directory) as tempdir:
+        logger.debug("Tempdir dir is %s", tempdir)
 
-            zip_path = make_file_name(tempdir, folder, "zip")
-            logger.debug("Zipfile path is %s.", zip_path.as_posix())
+        mbox_name = make_file_name(tempdir, folder, "mbox").name
+        if compression == zipfile.ZIP_BZIP2:
+            archive_path = make_file_name(tempdir, folder, "mbox.bz2")
+            content_type = "application/x-bzip2"
+        else:
+            archive_path = make_file_name(tempdir, folder, "zip")
+            content_type = "application/zip"
+        logger.debug("Archive path is %s.", archive_path.as_posix())
 
-            if zip_path.exists():
-                zip_path.unlink()
-            mbox_zip = zipfile.ZipFile(
-                zip_path,
-                mode="x",
-                compression=zipfile.ZIP_BZIP2,
-            )
-            mbox_zip.write(mbox_path, arcname=mbox_path.name)
-            mbox_zip.close()
-            logger.debug("Zipfile written.")
+        if archive_path.exists():
+            archive_path.unlink()
 
-            place_message(connection, tempdir, folder)
+        passed_in = connection
+        if passed_in is None:
+            connection = open_connection(login, verbose=_DBG)
+        else:
+            connection = refresh_connection(connection, login)
+
+        finished = False
+        try:
+            # the mbox is written straight into the archive, never to disk
+            with open_archive(
+                archive_path, mbox_name, compression, compresslevel
+            ) as mbox_file:
+                # fetching, framing and compressing each run on their own
+                # threads, so the network is busy while the zip is written
+                messages = get_folder_emails_parallel(
+                    login, folder, connection, pool)
+                from_line = "From MAILER-DAEMON@marner {}\n".format(
+                    time.asctime(time.gmtime())).encode("us-ascii")
+                try:
+                    for chunk in _threaded(
+                            frame_messages(messages, from_line)):
+                        mbox_file.write(chunk)
+
+                except ImapRuntimeError as err:
+                    logger.critical("Saving email failed: %s", err)
+                    raise
+
+            logger.debug("Archive written.")
+
+            # the server may have dropped us while the zip was written
+            connection = refresh_connection(connection, login)
+            place_message(connection, archive_path, content_type)
+            finished = True
+
+        finally:
+            # close connections opened here, unless returning one
+            if passed_in is None or (
+                    not finished and connection is not passed_in):
+                close_connection(connection)
+
+    return connection
@@ -3,7 +3,12 @@
 import logging
 
 from .gui import App, tk
-from .backup import collect_emails, ImapRuntimeError
+from .backup import (
+    collect_emails,
+    open_connection,
+    close_connection,
+    ImapRuntimeError,
+)
 
 
 logging.basicConfig(
@@ -11,6 +16,38 @@ logging.basicConfig(
 )
 
 
+# connections kept open between backups, with the login they belong to:
+# the main one and a pool of extra ones for fetching in parallel
+_imap = {"login": None, "connection": None, "pool": []}
+
+
+def _get_connection(server_login):
+    """Return a connection for server_login, reusing the last one.
+
+    collect_emails checks a reused connection is still alive.
+    """
+
+    if _imap["login"] != server_login:
+        _close_connection()
+    connection = _imap["connection"]
+
+    if connection is None:
+        connection = open_connection(server_login)
+
+    _imap.update(login=server_login, connection=connection)
+    return connection
+
+
+def _close_connection():
+    """Log out of all connections kept open between backups."""
+
+    if _imap["connection"] is not None:
+        close_connection(_imap["connection"])
+    for extra in _imap["pool"]:
+        close_connection(extra)
+    _imap.update(login=None, connection=None, pool=[])
+
+
 def _do_backup():
 
     app.disable_submit(True)
@@ -24,15 +61,28 @@ def _do_backup():
     )
     folder = dialog_values["Folder name"]
 
+    # after any failure the connection may be in any state, so start
+    # afresh next time
     try:
-        collect_emails(server_login, folder)
+        _imap["connection"] = collect_emails(
+            server_login,
+            folder,
+            connection=_get_connection(server_login),
+            pool=_imap["pool"],
+        )
 
     except ImapRuntimeError:
-        pass
+        _close_connection()
+
+    except Exception:
+        _close_connection()
+        raise
 
-    app.disable_submit(False)
+    finally:
+        app.disable_submit(False)
 
 
 root = tk.Tk()
 app = App(root, callback=_do_backup)
 root.mainloop()
+_close_connection()
@@ -30,6 +30,8 @@ class App(ttk.Frame):   # pylint: disable=too-many-ancestors
         "Folder name",
     ]
 
+    LABEL_WIDTH = max(len(label) for label in labels)
+
     def __init__(self, master, callback, *args, **kwargs):
         super().__init__(master=master, *args, **kwargs)
 
@@ -39,9 +41,7 @@ class App(ttk.Frame):   # pylint: disable=too-many-ancestors
         form_frame = ttk.Frame(relief=tk.SUNKEN, borderwidth=3)
         form_frame.pack(fill=tk.X)
 
-        label_width = max(len(label) for label in self.labels)
-
-        self.form_rows = {name: FormRow(form_frame, label_width, name)
+        self.form_rows = {name: FormRow(form_frame, self.LABEL_WIDTH, name)
                           for name in self.labels
                           }
 
@@ -95,17 +95,17 @@ class FormRow():
                              text=label_text)
         self.lbl.pack(side=tk.LEFT)
 
-        self.content = tk.StringVar()
-        self.txt = ttk.Entry(master=self.frm, textvariable=self.content)
+        self.txt = ttk.Entry(master=self.frm)
         self.txt.pack(side=tk.LEFT, fill=tk.X, expand=True)
 
         self.btn = None
 
     def _set_content(self, textvalue):
-        self.content.set(textvalue)
+        self.txt.delete(0, tk.END)
+        self.txt.insert(0, textvalue)
 
     def _get_content(self):
-        return self.content.get()
+        return self.txt.get()
 
     text = property(_get_content, _set_content,
                     doc="Text value of entry widget"
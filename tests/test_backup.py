@@ -0,0 +1,468 @@
+import bz2
+import email
+import email.policy
+import imaplib
+import io
+import random
+import threading
+import time
+import zlib
+
+import pytest
+
+from marner import backup
+
+
+FROM_LINE = b"From MAILER-DAEMON@marner Thu Jan  1 00:00:00 1970\n"
+
+
+class AppendRecorder:
+    """Stands in for a connection, keeping the message appended."""
+
+    def __init__(self):
+        self.mailbox = None
+        self.message = None
+
+    def append_file(self, mailbox, message, size):
+        self.mailbox = mailbox
+        self.message = message.read(size)
+        return "OK", [b"APPEND completed"]
+
+
+def test_frame_messages_escapes_from_lines():
+    eml = io.BytesIO(
+        b"Subject: test\r\n\r\nFrom here\r\n>From there\r\n"
+        b">>From everywhere\r\nnot From\r\n"
+    )
+
+    mbox = b"".join(backup.frame_messages([eml], FROM_LINE))
+
+    assert mbox == (
+        FROM_LINE
+        + b"Subject: test\n\n>From here\n>>From there\n"
+        b">>>From everywhere\nnot From\n\n"
+    )
+
+
+def test_frame_messages_separates_messages():
+    emls = [io.BytesIO(b"Subject: one\r\n\r\nbody\r\n"),
+            io.BytesIO(b"Subject: two\r\n\r\nbody\r\n")]
+
+    mbox = b"".join(backup.frame_messages(emls, FROM_LINE))
+
+    assert mbox.count(FROM_LINE) == 2
+    assert mbox.endswith(b"body\n\n")
+
+
+def test_fetch_responses_uid_before_literal():
+    data = [(b"1 (UID 5 BODY[] {3}", b"abc"), b")"]
+
+    assert list(backup._fetch_responses(data)) == [
+        (5, b"1 (UID 5 BODY[] {3})", b"abc")
+    ]
+
+
+def test_fetch_responses_uid_after_literal():
+    data = [
+        (b"1 (UID 5 BODY[] {3}", b"abc"),
+        b")",
+        (b"2 (BODY[] {2}", b"de"),
+        b" UID 9)",
+    ]
+
+    uids = [(uid, literal)
+            for uid, _, literal in backup._fetch_responses(data)]
+
+    assert uids == [(5, b"abc"), (9, b"de")]
+
+
+def test_place_message_round_trip(tmp_path):
+    archive_path = tmp_path / "Folder.zip"
+    archive = bytes(range(256)) * 1000
+    archive_path.write_bytes(archive)
+    connection = AppendRecorder()
+
+    backup.place_message(connection, archive_path)
+
+    msg = email.message_from_bytes(
+        connection.message, policy=email.policy.default)
+    attachment, = msg.iter_attachments()
+    assert connection.mailbox == "INBOX"
+    assert msg["Subject"] == "Back up email folder"
+    assert attachment.get_content_type() == "application/zip"
+    assert attachment.get_filename() == "Folder.zip"
+    assert attachment.get_content() == archive
+
+
+def test_place_message_empty_archive(tmp_path):
+    archive_path = tmp_path / "Folder.zip"
+    archive_path.write_bytes(b"")
+    connection = AppendRecorder()
+
+    backup.place_message(connection, archive_path)
+
+    msg = email.message_from_bytes(
+        connection.message, policy=email.policy.default)
+    attachment, = msg.iter_attachments()
+    assert attachment.get_content() == b""
+
+
+def test_parallel_bz2_writer_round_trip():
+    data = bytes(range(256)) * 10000
+    output = io.BytesIO()
+
+    with backup.ParallelBz2Writer(output, workers=2) as writer:
+        for start in range(0, len(data), 100000):
+            writer.write(data[start:start + 100000])
+
+    # one bzip2 stream per block
+    assert output.getvalue().count(b"BZh9") >= 3
+    assert bz2.decompress(output.getvalue()) == data
+
+
+def test_parallel_bz2_writer_empty():
+    output = io.BytesIO()
+
+    with backup.ParallelBz2Writer(output):
+        pass
+
+    assert output.getvalue()
+    assert bz2.decompress(output.getvalue()) == b""
+
+
+def test_frame_messages_strips_one_line_ending():
+    eml = io.BytesIO(b"Subject: test\r\n\r\nx\r\r\ny\rz\nend")
+
+    mbox = b"".join(backup.frame_messages([eml], FROM_LINE))
+
+    assert mbox == FROM_LINE + b"Subject: test\n\nx\r\ny\rz\nend\n\n"
+
+
+def test_frame_messages_long_lines(monkeypatch):
+    monkeypatch.setattr(backup, "LITERAL_CHUNK_SIZE", 8)
+    eml = io.BytesIO(b"From abcdefghij\r\nabcdefg\r\nFrom x\r\nabcdefghij")
+
+    mbox = b"".join(backup.frame_messages([eml], FROM_LINE))
+
+    assert mbox == (FROM_LINE + b">From abcdefghij\nabcdefg\n>From x\n"
+                    b"abcdefghij\n\n")
+
+
+class TrackedFile(io.BytesIO):
+    """Message file which counts how many are open at once."""
+
+    lock = threading.Lock()
+    open_now = 0
+    most_open = 0
+
+    def __init__(self, data):
+        super().__init__(data)
+        with self.lock:
+            TrackedFile.open_now += 1
+            TrackedFile.most_open = max(TrackedFile.most_open,
+                                        TrackedFile.open_now)
+
+    def close(self):
+        if not self.closed:
+            with self.lock:
+                TrackedFile.open_now -= 1
+        super().close()
+
+
+class FakeFolder:
+    """Stands in for a connection with a folder of numbered messages."""
+
+    def __init__(self, count, fail_uid=None, select_ok=True):
+        self.count = count
+        self.fail_uid = fail_uid
+        self.select_ok = select_ok
+        self.logged_out = False
+
+    @staticmethod
+    def message(uid):
+        return b"Subject: %d\r\n\r\nbody\r\n" % uid
+
+    def select(self, folder):
+        return ("OK" if self.select_ok else "NO"), [b""]
+
+    def uid(self, command, *args):
+        if command == "search":
+            return "OK", [" ".join(
+                str(uid) for uid in range(1, self.count + 1)).encode()]
+
+        uids = [int(uid) for uid in args[0].split(",")]
+        if args[1] == "(UID RFC822.SIZE)":
+            return "OK", [b"%d (UID %d RFC822.SIZE %d)"
+                          % (uid, uid, len(self.message(uid)))
+                          for uid in uids]
+
+        time.sleep(random.random() / 100)
+        if self.fail_uid in uids:
+            raise imaplib.IMAP4.abort("connection lost")
+
+        data = []
+        for uid in uids:
+            eml = self.message(uid)
+            data.append((b"%d (UID %d BODY[] {%d}" % (uid, uid, len(eml)),
+                         TrackedFile(eml)))
+            data.append(b")")
+        return "OK", data
+
+    def logout(self):
+        self.logged_out = True
+
+
+@pytest.fixture
+def extra_connections(monkeypatch):
+    """Patch open_connection to hand out FakeFolders, and list them."""
+
+    opened = []
+
+    def open_connection(login, verbose=False):
+        opened.append(FakeFolder(login["count"], **login["extra"]))
+        return opened[-1]
+
+    monkeypatch.setattr(backup, "open_connection", open_connection)
+    monkeypatch.setattr(backup, "FETCH_BATCH_SIZE", 10)
+    TrackedFile.open_now = TrackedFile.most_open = 0
+    return opened
+
+
+def subjects(emls):
+    return [int(eml.readline().split()[1]) for eml in emls]
+
+
+def test_parallel_fetch_in_uid_order(extra_connections):
+    login = {"count": 250, "extra": {}}
+
+    emls = backup.get_folder_emails_parallel(login, "x", FakeFolder(250))
+
+    assert subjects(emls) == list(range(1, 251))
+    assert len(extra_connections) == backup.DEFAULT_CONNECTIONS - 1
+    assert all(conn.logged_out for conn in extra_connections)
+    assert TrackedFile.open_now == 0
+    assert TrackedFile.most_open <= (
+        backup.FETCH_AHEAD * backup.DEFAULT_CONNECTIONS * 10)
+
+
+def test_parallel_fetch_worker_failure(extra_connections):
+    login = {"count": 250, "extra": {"fail_uid": 125}}
+
+    with pytest.raises(backup.ImapRuntimeError):
+        subjects(backup.get_folder_emails_parallel(
+            login, "x", FakeFolder(250, fail_uid=125)))
+
+    assert all(conn.logged_out for conn in extra_connections)
+    assert TrackedFile.open_now == 0
+
+
+def test_parallel_fetch_early_close(extra_connections):
+    login = {"count": 250, "extra": {}}
+
+    emls = backup.get_folder_emails_parallel(login, "x", FakeFolder(250))
+    next(emls)
+    emls.close()
+
+    assert extra_connections
+    assert all(conn.logged_out for conn in extra_connections)
+    assert TrackedFile.open_now == 0
+
+
+def test_parallel_fetch_extra_cannot_select(extra_connections):
+    login = {"count": 250, "extra": {"select_ok": False}}
+
+    emls = backup.get_folder_emails_parallel(login, "x", FakeFolder(250))
+
+    assert subjects(emls) == list(range(1, 251))
+    assert len(extra_connections) == 1
+    assert extra_connections[0].logged_out
+
+
+class FakeHeaders:
+    """Stands in for a connection answering a header-only fetch."""
+
+    def select(self, folder):
+        return "OK", [b""]
+
+    def uid(self, command, *args):
+        if command == "search":
+            return "OK", [b"3 4"]
+        return "OK", [
+            (b'1 (UID 3 RFC822.SIZE 1234 INTERNALDATE '
+             b'"17-Jul-1996 02:44:25 -0700" BODY[HEADER] {3}', b"abc"),
+            b")",
+            (b"2 (UID 4 BODY[HEADER] {2}", b"de"),
+            b' RFC822.SIZE 99 INTERNALDATE "18-Jul-1996 02:44:25 -0700")',
+        ]
+
+
+def test_get_folder_emails_headers_only():
+    headers = list(backup.get_folder_emails(FakeHeaders(), "x", body=False))
+
+    assert [(uid, text, size) for uid, text, size, _ in headers] == [
+        (3, b"abc", 1234), (4, b"de", 99)]
+    assert headers[0][3] == imaplib.Internaldate2tuple(
+        b'INTERNALDATE "17-Jul-1996 02:44:25 -0700"')
+    assert headers[1][3] == imaplib.Internaldate2tuple(
+        b'INTERNALDATE "18-Jul-1996 02:44:25 -0700"')
+
+
+class PooledFolder(FakeFolder):
+    """FakeFolder which answers NOOP, so it can be reused from a pool."""
+
+    def noop(self):
+        return "OK", [b""]
+
+
+def test_parallel_fetch_reuses_pool(extra_connections, monkeypatch):
+    def open_connection(login, verbose=False):
+        extra_connections.append(PooledFolder(login["count"]))
+        return extra_connections[-1]
+
+    monkeypatch.setattr(backup, "open_connection", open_connection)
+    login = {"count": 250, "extra": {}}
+    pool = []
+
+    for _ in range(2):
+        emls = backup.get_folder_emails_parallel(
+            login, "x", FakeFolder(250), pool)
+        assert subjects(emls) == list(range(1, 251))
+
+    assert len(extra_connections) == backup.DEFAULT_CONNECTIONS - 1
+    assert pool == extra_connections
+    assert not any(conn.logged_out for conn in pool)
+
+
+def test_threaded_early_close():
+    threads = threading.active_count()
+
+    def produce():
+        while True:
+            yield b"chunk"
+
+    items = backup._threaded(produce(), maxsize=2)
+    assert next(items) == b"chunk"
+    items.close()
+
+    assert threading.active_count() == threads
+
+
+def test_threaded_early_close_parallel_fetch(extra_connections):
+    threads = threading.active_count()
+    login = {"count": 250, "extra": {}}
+    messages = backup.get_folder_emails_parallel(
+        login, "x", FakeFolder(250))
+
+    chunks = backup._threaded(backup.frame_messages(messages, FROM_LINE))
+    next(chunks)
+    chunks.close()
+
+    assert threading.active_count() == threads
+    assert all(conn.logged_out for conn in extra_connections)
+
+
+def test_threaded_producer_exception():
+    def produce():
+        yield b"chunk"
+        raise ValueError("producer failed")
+
+    items = backup._threaded(produce())
+
+    assert next(items) == b"chunk"
+    with pytest.raises(ValueError, match="producer failed"):
+        next(items)
+
+
+class TrickleSocket(io.RawIOBase):
+    """Socket file which returns a few bytes per read, and records sends."""
+
+    def __init__(self, data, step=7):
+        super().__init__()
+        self.data = data
+        self.step = step
+        self.sent = b""
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        size = min(len(buffer), self.step, len(self.data))
+        buffer[:size] = self.data[:size]
+        self.data = self.data[size:]
+        return size
+
+    def sendall(self, data):
+        self.sent += data
+
+
+def compressed_connection(server_data, step=7):
+    """Make a compressed SpoolingIMAP4_SSL reading server_data."""
+
+    deflate = zlib.compressobj(wbits=-15)
+    stream = TrickleSocket(
+        deflate.compress(server_data) + deflate.flush(zlib.Z_SYNC_FLUSH),
+        step,
+    )
+
+    conn = object.__new__(backup.SpoolingIMAP4_SSL)
+    conn.file = io.BufferedReader(stream)
+    conn.sock = stream
+    conn._start_compression()
+    return conn
+
+
+def test_compressed_lines_across_reads():
+    conn = compressed_connection(
+        b"* OK first line\r\n* 1 FETCH (BODY[] {5}\r\nhello)\r\n")
+
+    assert conn.readline() == b"* OK first line\r\n"
+    assert conn.readline() == b"* 1 FETCH (BODY[] {5}\r\n"
+    assert conn.read(5) == b"hello"
+    assert conn.readline() == b")\r\n"
+
+
+def test_compressed_large_literal():
+    literal = bytes(range(256)) * 4096 + b"\0" * (4 << 20)
+    conn = compressed_connection(
+        b"* 1 FETCH (BODY[] {%d}\r\n" % len(literal) + literal
+        + b")\r\nA1 OK done\r\n", step=1 << 16)
+
+    buffered = []
+    fill = conn._fill
+
+    def recording_fill():
+        fill()
+        buffered.append(len(conn._inbuf))
+
+    conn._fill = recording_fill
+    conn.readline()
+    spool = conn.read(len(literal))
+
+    # only about one chunk is ever held decompressed
+    assert max(buffered) <= 2 * backup.LITERAL_CHUNK_SIZE
+    assert spool.read() == literal
+    assert conn.readline() == b")\r\n"
+    assert conn.readline() == b"A1 OK done\r\n"
+
+
+def test_compressed_send():
+    conn = compressed_connection(b"")
+
+    conn.send(b"A2 NOOP\r\n")
+
+    inflate = zlib.decompressobj(wbits=-15)
+    assert inflate.decompress(conn.sock.sent) == b"A2 NOOP\r\n"
+
+
+def test_compress_refused(monkeypatch):
+    conn = object.__new__(backup.SpoolingIMAP4_SSL)
+    conn.capabilities = ("IMAP4REV1", "COMPRESS=DEFLATE")
+
+    def refuse(*args):
+        raise conn.error("COMPRESS command error: BAD")
+
+    monkeypatch.setattr(conn, "_get_capabilities", lambda: None, False)
+    monkeypatch.setattr(conn, "_simple_command", refuse, False)
+
+    assert not conn.compress()
+    assert conn._decompressor is None